@@ -1,8 +1,14 @@
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from os import path as osp
 from PIL import Image
 
 from basicsr.utils import scandir
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
 
 def generate_meta_info():
     """Generate meta info for DIV2K dataset.
@@ -13,22 +19,56 @@ def generate_meta_info():
 
     img_list = sorted(list(scandir(gt_folder)))
 
-    with open(meta_info_txt, 'w') as f:
-        for idx, img_path in enumerate(img_list):
-            img = Image.open(osp.join(gt_folder, img_path))  # lazy load
-            width, height = img.size
-            mode = img.mode
-            if mode == 'RGB':
-                n_channel = 3
-            elif mode == 'L':
-                n_channel = 1
-            else:
-                raise ValueError(f'Unsupported mode {mode}.')
-
+    # map preserves input order, so the main process stays the single (sorted) writer
+    lines = []
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(partial(probe_image, gt_folder), img_list, chunksize=64)
+        for idx, (img_path, height, width, n_channel) in enumerate(results):
             info = f'{img_path} ({height},{width},{n_channel})'
-            print(idx + 1, info)
-            f.write(f'{info}\n')
+            if (idx + 1) % 1000 == 0:
+                print(idx + 1, info)
+            lines.append(f'{info}\n')
+
+    # write bytes in one go to skip the text codec layer
+    with open(meta_info_txt, 'wb', buffering=1 << 20) as f:
+        f.write(''.join(lines).encode('utf-8'))
+    print(f'Write {len(lines)} lines to {meta_info_txt}.')
+
+
+def probe_image(gt_folder, img_path):
+    """Worker for each process.
+    Args:
+        gt_folder (str): Path to the image folder.
+        img_path (str): Image path relative to gt_folder.
+    Returns:
+        tuple: (img_path, height, width, n_channel).
+    """
+    path = osp.join(gt_folder, img_path)
+    with open(path, 'rb') as f:
+        header = f.read(26)
+
+    mode = None
+    if header[:8] == PNG_SIGNATURE and header[12:16] == b'IHDR':
+        # read size and color type from the IHDR chunk, without initializing a decoder.
+        # only 8-bit RGB/L are decided here, other PNG variants go through PIL to keep its mode mapping
+        width, height, bit_depth, color_type = struct.unpack('>IIBB', header[16:26])
+        if bit_depth == 8 and color_type == 2:
+            mode = 'RGB'
+        elif bit_depth == 8 and color_type == 0:
+            mode = 'L'
+    if mode is None:
+        img = Image.open(path)  # lazy load
+        width, height = img.size
+        mode = img.mode
+
+    if mode == 'RGB':
+        n_channel = 3
+    elif mode == 'L':
+        n_channel = 1
+    else:
+        raise ValueError(f'Unsupported mode {mode}.')
+    return img_path, height, width, n_channel
 
 
 if __name__ == '__main__':
-    generate_meta_info()
\ No newline at end of file
+    generate_meta_info()
@@ -4,15 +4,124 @@ from torch.nn import functional as F
 from basicsr.utils.registry import MODEL_REGISTRY
 from basicsr.models.sr_model import SRModel
 from basicsr.metrics import calculate_metric
-from basicsr.utils import imwrite, tensor2img
+from basicsr.utils import get_root_logger, imwrite, tensor2img
+from basicsr.utils.dist_util import master_only
 
+import copy
 import math
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from os import path as osp
 
+
+def _to_cpu(obj):
+    """Recursively copy tensors in a (nested) state dict to cpu, so that it is safe to serialize in another thread."""
+    if isinstance(obj, torch.Tensor):
+        return obj.to('cpu', copy=True)
+    if type(obj) in (dict, OrderedDict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    if type(obj) in (list, tuple):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def _atomic_torch_save(obj, save_path):
+    """torch.save to a .tmp file and os.replace it, so that a crash never leaves a truncated file."""
+    tmp_path = f'{save_path}.tmp'
+    # avoid occasional writing errors
+    retry = 3
+    for attempt in range(retry):
+        try:
+            torch.save(obj, tmp_path)
+            os.replace(tmp_path, save_path)
+        except Exception as e:
+            logger = get_root_logger()
+            logger.warning(f'Save {save_path} error: {e}, remaining retry times: {retry - attempt - 1}')
+            time.sleep(1)
+        else:
+            break
+    else:
+        if osp.exists(tmp_path):
+            os.remove(tmp_path)
+        logger = get_root_logger()
+        logger.warning(f'Still cannot save {save_path}. Just ignore it.')
+
+
 @MODEL_REGISTRY.register()
 class HATModel(SRModel):
 
+    def init_training_settings(self):
+        super(HATModel, self).init_training_settings()
+        train_opt = self.opt['train']
+
+        # mixed precision: None (fp32), 'bf16' or 'fp16'
+        amp = train_opt.get('amp')
+        if amp is None:
+            self.amp_dtype = None
+        elif amp == 'bf16':
+            self.amp_dtype = torch.bfloat16
+        elif amp == 'fp16':
+            self.amp_dtype = torch.float16
+        else:
+            raise ValueError(f"Wrong amp {amp}. Supported ones are: None, 'bf16', 'fp16'.")
+        # bf16 has the fp32 exponent range, only fp16 needs loss scaling
+        self.grad_scaler = torch.cuda.amp.GradScaler(enabled=self.amp_dtype == torch.float16)
+
+        self.channels_last = train_opt.get('channels_last', False)
+        if self.channels_last:
+            self.net_g = self.net_g.to(memory_format=torch.channels_last)
+
+        # the training patch size is fixed, so compile the forward with static shapes (torch>=2.0).
+        # net_g itself stays uncompiled for saving, ema updates and validation on full images.
+        if train_opt.get('compile', False):
+            self.net_g_train = torch.compile(self.net_g, mode='max-autotune', dynamic=False)
+        else:
+            self.net_g_train = self.net_g
+
+    def resume_training(self, resume_state):
+        super(HATModel, self).resume_training(resume_state)
+        if self.grad_scaler.is_enabled() and 'grad_scaler' in resume_state:
+            self.grad_scaler.load_state_dict(resume_state['grad_scaler'])
+
+    def feed_data(self, data):
+        super(HATModel, self).feed_data(data)
+        if getattr(self, 'channels_last', False):
+            self.lq = self.lq.contiguous(memory_format=torch.channels_last)
+
+    def optimize_parameters(self, current_iter):
+        self.optimizer_g.zero_grad()
+        with torch.autocast('cuda', dtype=self.amp_dtype or torch.float32, enabled=self.amp_dtype is not None):
+            self.output = self.net_g_train(self.lq)
+
+            l_total = 0
+            loss_dict = OrderedDict()
+            # pixel loss
+            if self.cri_pix:
+                l_pix = self.cri_pix(self.output, self.gt)
+                l_total += l_pix
+                loss_dict['l_pix'] = l_pix
+            # perceptual loss
+            if self.cri_perceptual:
+                l_percep, l_style = self.cri_perceptual(self.output, self.gt)
+                if l_percep is not None:
+                    l_total += l_percep
+                    loss_dict['l_percep'] = l_percep
+                if l_style is not None:
+                    l_total += l_style
+                    loss_dict['l_style'] = l_style
+
+        self.grad_scaler.scale(l_total).backward()
+        self.grad_scaler.step(self.optimizer_g)
+        self.grad_scaler.update()
+
+        self.log_dict = self.reduce_loss_dict(loss_dict)
+
+        if self.ema_decay > 0:
+            self.model_ema(decay=self.ema_decay)
+
     def pre_process(self):
         # pad to multiplication of window_size
         window_size = self.opt['network_g']['window_size']
@@ -111,6 +220,60 @@ class HATModel(SRModel):
         _, _, h, w = self.output.size()
         self.output = self.output[:, :, 0:h - self.mod_pad_h * self.scale, 0:w - self.mod_pad_w * self.scale]
 
+    @master_only
+    def save(self, epoch, current_iter):
+        """Save networks and training states in a background thread.
+
+        Everything is copied to cpu first, so training can go on while the files are written.
+        """
+        self.wait_for_save()
+        label = 'latest' if current_iter == -1 else current_iter
+
+        if hasattr(self, 'net_g_ema'):
+            nets, param_keys = [self.net_g, self.net_g_ema], ['params', 'params_ema']
+        else:
+            nets, param_keys = [self.net_g], ['params']
+        save_dict = {}
+        for net, param_key in zip(nets, param_keys):
+            state_dict = self.get_bare_model(net).state_dict()
+            save_dict[param_key] = OrderedDict(
+                (key[7:] if key.startswith('module.') else key, param.to('cpu', copy=True))
+                for key, param in state_dict.items())
+        net_path = osp.join(self.opt['path']['models'], f'net_g_{label}.pth')
+
+        state, state_path = None, None
+        if current_iter != -1:
+            state = {'epoch': epoch, 'iter': current_iter, 'optimizers': [], 'schedulers': []}
+            for o in self.optimizers:
+                state['optimizers'].append(_to_cpu(o.state_dict()))
+            for s in self.schedulers:
+                state['schedulers'].append(_to_cpu(s.state_dict()))
+            if self.grad_scaler.is_enabled():  # fp16 loss scaling
+                state['grad_scaler'] = _to_cpu(self.grad_scaler.state_dict())
+            state_path = osp.join(self.opt['path']['training_states'], f'{current_iter}.state')
+
+        if not hasattr(self, 'saver'):
+            self.saver = ThreadPoolExecutor(max_workers=1)
+        self.save_future = self.saver.submit(self._write_checkpoint, save_dict, net_path, state, state_path)
+
+    def wait_for_save(self):
+        """Block until the pending background save is written, re-raising its error if any."""
+        if getattr(self, 'save_future', None) is not None:
+            self.save_future.result()
+            self.save_future = None
+
+    def _write_checkpoint(self, save_dict, net_path, state, state_path):
+        _atomic_torch_save(save_dict, net_path)
+        if state is not None:
+            _atomic_torch_save(state, state_path)
+            # point training_states/latest.state to the newest state, so that
+            # load_resume_state does not need to scan the folder
+            latest_tmp = osp.join(osp.dirname(state_path), 'latest.state.tmp')
+            if osp.lexists(latest_tmp):
+                os.remove(latest_tmp)
+            os.symlink(osp.basename(state_path), latest_tmp)
+            os.replace(latest_tmp, osp.join(osp.dirname(state_path), 'latest.state'))
+
     def nondist_validation(self, dataloader, current_iter, tb_logger, save_img):
         dataset_name = dataloader.dataset.opt['name']
         with_metrics = self.opt['val'].get('metrics') is not None
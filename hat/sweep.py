@@ -10,11 +10,14 @@ import models
 import wandb
 
 import datetime
+import inspect
 import logging
 import math
 import time
 import torch
 import os
+import hashlib
+import pickle
 from os import path as osp
 import random
 import yaml
@@ -26,8 +29,10 @@ from basicsr.data.prefetch_dataloader import CPUPrefetcher, CUDAPrefetcher
 from basicsr.models import build_model
 from basicsr.utils import (AvgTimer, MessageLogger, check_resume, get_env_info, get_root_logger, get_time_str,
                            init_tb_logger, init_wandb_logger, make_exp_dirs, mkdir_and_rename, scandir, set_random_seed)
-from basicsr.utils.options import copy_opt_file, dict2str
+from basicsr.utils.options import _postprocess_yml_value, copy_opt_file, dict2str
 from basicsr.utils.dist_util import get_dist_info, init_dist
+
+YAML_CACHE_DIR = osp.expanduser('~/.cache/hat_yaml')
     
 def init_tb_loggers(opt):
     # initialize wandb logger before tensorboard logger to allow proper sync
@@ -48,6 +53,10 @@ def create_train_val_dataloader(opt, logger):
             dataset_enlarge_ratio = dataset_opt.get('dataset_enlarge_ratio', 1)
             train_set = build_dataset(dataset_opt)
             train_sampler = EnlargedSampler(train_set, opt['world_size'], opt['rank'], dataset_enlarge_ratio)
+            # keep workers alive across epochs and pin batches for both cpu and cuda prefetchers
+            if dataset_opt.get('num_worker_per_gpu', 0) > 0:
+                dataset_opt.setdefault('persistent_workers', True)
+            dataset_opt.setdefault('pin_memory', True)
             train_loader = build_dataloader(
                 train_set,
                 dataset_opt,
@@ -83,8 +92,14 @@ def load_resume_state(opt):
     resume_state_path = None
     if opt['auto_resume']:
         state_path = osp.join('experiments', opt['name'], 'training_states')
-        if osp.isdir(state_path):
+        latest_path = osp.join(state_path, 'latest.state')
+        if osp.islink(latest_path) and osp.isfile(latest_path):
+            resume_state_path = osp.join(state_path, os.readlink(latest_path))
+            opt['path']['resume_state'] = resume_state_path
+        elif osp.isdir(state_path):
+            # fall back to scanning for experiments saved without the latest.state link
             states = list(scandir(state_path, suffix='state', recursive=False, full_path=False))
+            states = [v for v in states if v != 'latest.state']
             if len(states) != 0:
                 states = [float(v.split('.state')[0]) for v in states]
                 resume_state_path = osp.join(state_path, f'{max(states):.0f}.state')
@@ -96,8 +111,11 @@ def load_resume_state(opt):
     if resume_state_path is None:
         resume_state = None
     else:
-        device_id = torch.cuda.current_device()
-        resume_state = torch.load(resume_state_path, map_location=lambda storage, loc: storage.cuda(device_id))
+        # load to (memory-mapped) cpu storage, optimizer.load_state_dict moves the states to the param devices
+        if 'mmap' in inspect.signature(torch.load).parameters:  # torch>=2.1
+            resume_state = torch.load(resume_state_path, map_location='cpu', mmap=True, weights_only=False)
+        else:
+            resume_state = torch.load(resume_state_path, map_location='cpu')
         check_resume(opt, resume_state['iter'])
     return resume_state
 
@@ -107,10 +125,12 @@ def ordered_yaml():
         tuple: yaml Loader and Dumper.
     """
     try:
-        from yaml import CDumper as Dumper
-        from yaml import CLoader as Loader
+        from yaml import CSafeDumper as Dumper
+        from yaml import CSafeLoader as Loader
     except ImportError:
-        from yaml import Dumper, Loader
+        raise ImportError('libyaml bindings (CSafeLoader/CSafeDumper) are not available. Please install libyaml '
+                          '(e.g., apt install libyaml-dev) and reinstall PyYAML with '
+                          'pip install pyyaml --force-reinstall --no-binary :all:')
 
     _mapping_tag = yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG
 
@@ -125,6 +145,10 @@ def ordered_yaml():
     return Loader, Dumper
 
 
+# register the OrderedDict representer/constructor once at import time
+YAML_LOADER, YAML_DUMPER = ordered_yaml()
+
+
 def yaml_load(f):
     """Load yaml file or string.
     Args:
@@ -133,11 +157,46 @@ def yaml_load(f):
         dict: Loaded dict.
     """
     if os.path.isfile(f):
-        with open(f, 'r') as f:
-            return yaml.load(f, Loader=ordered_yaml()[0])
+        with open(f, 'rb') as f:
+            content = f.read()
+        # parse once per content hash, sweep runs reuse the pickled dict. The loader, the PyYAML version and the
+        # pickle protocol are part of the key, since the cache folder is shared by every python env in $HOME
+        cache_key = hashlib.sha1(content)
+        cache_key.update(f'{YAML_LOADER.__module__}.{YAML_LOADER.__name__}:{yaml.__version__}:'
+                         f'{pickle.HIGHEST_PROTOCOL}'.encode('utf-8'))
+        cache_path = osp.join(YAML_CACHE_DIR, f'{cache_key.hexdigest()}.pkl')
+        if osp.isfile(cache_path):
+            try:
+                with open(cache_path, 'rb') as cache_f:
+                    return pickle.load(cache_f)
+            except Exception:
+                pass  # any unreadable cache entry is a cache miss
+        opt = yaml.load(content, Loader=YAML_LOADER)
+        try:
+            os.makedirs(YAML_CACHE_DIR, exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as cache_f:
+                pickle.dump(opt, cache_f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+        return opt
     else:
-        return yaml.load(f, Loader=ordered_yaml()[0])
-    
+        return yaml.load(f, Loader=YAML_LOADER)
+
+
+def set_nested(d, keys, value):
+    """Set a value in a nested dict.
+    Args:
+        d (dict): Dict to update.
+        keys (list[str]): Key path, e.g., ['train', 'ema_decay'].
+        value: Value to set.
+    """
+    for key in keys[:-1]:
+        d = d[key]
+    d[keys[-1]] = value
+
+
 def parse_options(root_path, is_train=True):
     import argparse
     parser = argparse.ArgumentParser()
@@ -179,17 +238,11 @@ def parse_options(root_path, is_train=True):
 
     # force to update yml options
     if args.force_yml is not None:
-        for entry in args.force_yml:
-            # now do not support creating new keys
-            keys, value = entry.split('=')
-            keys, value = keys.strip(), value.strip()
-            value = _postprocess_yml_value(value)
-            eval_str = 'opt'
-            for key in keys.split(':'):
-                eval_str += f'["{key}"]'
-            eval_str += '=value'
-            # using exec function
-            exec(eval_str)
+        # parse all entries first, then apply them; now do not support creating new keys
+        overrides = [(keys.strip().split(':'), _postprocess_yml_value(value.strip()))
+                     for keys, value in (entry.split('=', 1) for entry in args.force_yml)]
+        for keys, value in overrides:
+            set_nested(opt, keys, value)
 
     opt['auto_resume'] = args.auto_resume
     opt['is_train'] = is_train
@@ -240,6 +293,7 @@ def parse_options(root_path, is_train=True):
 
     return opt, args
 
+
 # def config():
 #     import argparse
 #     parser = argparse.ArgumentParser()
@@ -256,31 +310,42 @@ def train_pipeline(root_path):
     opt, args = parse_options(root_path, is_train=True)
     opt['root_path'] = root_path
     
-    i=0
-    experiments_root = opt['path']['experiments_root']
-    while osp.exists(experiments_root):
-        i+=1
-        experiments_root = opt['path']['experiments_root'] + f'_{i}'
+    # pick the first free experiments_root suffix with a single listing of the parent folder
+    base_root = opt['path']['experiments_root']
+    parent_dir, base_name = osp.split(base_root)
+    existing = set(os.listdir(parent_dir)) if osp.isdir(parent_dir) else set()
+    i = 0
+    name = base_name
+    while name in existing:
+        i += 1
+        name = f'{base_name}_{i}'
+    experiments_root = osp.join(parent_dir, name)
     opt['path']['experiments_root'] = experiments_root
     opt['path']['models'] = osp.join(experiments_root, 'models')
     opt['path']['training_states'] = osp.join(experiments_root, 'training_states')
     opt['path']['log'] = experiments_root
     opt['path']['visualization'] = osp.join(experiments_root, 'visualization')
         
-    # wandb
-    if (opt['logger'].get('wandb') is not None) and (opt['logger']['wandb'].get('project') is not None):
+    # wandb, skipped for debug runs as in init_tb_loggers
+    wandb_enabled = (opt['logger'].get('wandb') is not None) and (opt['logger']['wandb'].get('project') is not None)
+    if wandb_enabled and 'debug' not in opt['name']:
         wandb.init(
             entity='seohyeonpark30',
             project='SR_dacon',
             name=opt['path']['experiments_root'].split('/')[-1],
-            config=vars(args)
+            config=vars(args),
+            mode=opt['logger']['wandb'].get('mode'),
+            settings=wandb.Settings(console='off')
         )
+    if wandb_enabled:
         opt['train']['optim_g']['type'] = args.optim
         opt['train']['optim_g']['lr'] = args.lr
         opt['train']['optim_g']['weight_decay'] = args.weight_decay
         opt['train']['optim_g']['betas'] = [args.b1, args.b2]
 
     torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     # torch.backends.cudnn.deterministic = True
 
     # load resume states if necessary
@@ -335,6 +400,12 @@ def train_pipeline(root_path):
 
     # training
     logger.info(f'Start training from epoch: {start_epoch}, iter: {current_iter}')
+    # hoist loop-invariant options out of the hot loop
+    print_freq = opt['logger']['print_freq']
+    save_checkpoint_freq = opt['logger']['save_checkpoint_freq']
+    val_freq = opt['val']['val_freq'] if opt.get('val') is not None else None
+    warmup_iter = opt['train'].get('warmup_iter', -1)
+    wandb_enabled = wandb_enabled and 'debug' not in opt['name']
     data_timer, iter_timer = AvgTimer(), AvgTimer()
     start_time = time.time()
     for epoch in range(start_epoch, total_epochs + 1):
@@ -349,7 +420,7 @@ def train_pipeline(root_path):
             if current_iter > total_iters:
                 break
             # update learning rate
-            model.update_learning_rate(current_iter, warmup_iter=opt['train'].get('warmup_iter', -1))
+            model.update_learning_rate(current_iter, warmup_iter=warmup_iter)
             # training
             model.feed_data(train_data)
             model.optimize_parameters(current_iter)
@@ -358,45 +429,45 @@ def train_pipeline(root_path):
                 # reset start time in msg_logger for more accurate eta_time
                 # not work in resume mode
                 msg_logger.reset_start_time()
+            do_log = current_iter % print_freq == 0
+            do_val = val_freq is not None and current_iter % val_freq == 0
             # log
-            if current_iter % opt['logger']['print_freq'] == 0:
+            if do_log:
+                lrs = model.get_current_learning_rate()
+                current_log = model.get_current_log()
                 log_vars = {'epoch': epoch, 'iter': current_iter}
-                log_vars.update({'lrs': model.get_current_learning_rate()})
+                log_vars.update({'lrs': lrs})
                 log_vars.update({'time': iter_timer.get_avg_time(), 'data_time': data_timer.get_avg_time()})
-                log_vars.update(model.get_current_log())
+                log_vars.update(current_log)
                 msg_logger(log_vars)
-                
-                
 
             # save models and training states
-            if current_iter % opt['logger']['save_checkpoint_freq'] == 0:
+            if current_iter % save_checkpoint_freq == 0:
                 logger.info('Saving models and training states.')
                 model.save(epoch, current_iter)
 
             # validation
-            if opt.get('val') is not None and (current_iter % opt['val']['val_freq'] == 0):
+            if do_val:
                 if len(val_loaders) > 1:
                     logger.warning('Multiple validation datasets are *only* supported by SRModel.')
                 for val_loader in val_loaders:
                     model.validation(val_loader, current_iter, tb_logger, opt['val']['save_img'])
-            
+
             # wandb
-            if (opt['logger'].get('wandb') is not None) and (opt['logger']['wandb'].get('project') is not None):
+            if wandb_enabled and (do_log or do_val):
                 wb_log_dict = {}
-                
-                if current_iter % opt['logger']['print_freq'] == 0:
-                    wb_log_dict = {'iter': current_iter,
-                                   'lrs': model.get_current_learning_rate()[0]}
-                    wb_log_dict.update(model.get_current_log())
-                    
-                    
-                if opt.get('val') is not None and (current_iter % opt['val']['val_freq'] == 0):
+
+                if do_log:
+                    wb_log_dict = {'iter': current_iter, 'lrs': lrs[0]}
+                    wb_log_dict.update(current_log)
+
+                if do_val:
                     for metric, value in model.metric_results.items():
                         wb_log_dict[metric] = value
                         wb_log_dict[f'best_{metric}'] = model.best_metric_results[val_loader.dataset.opt['name']][metric]["val"]
-                    
+
                 if len(wb_log_dict):
-                    wandb.log(wb_log_dict)
+                    wandb.log(wb_log_dict, step=current_iter)
             data_timer.start()
             iter_timer.start()
             train_data = prefetcher.next()
@@ -407,6 +478,8 @@ def train_pipeline(root_path):
     logger.info(f'End of training. Time consumed: {consumed_time}')
     logger.info('Save the latest model.')
     model.save(epoch=-1, current_iter=-1)  # -1 stands for the latest
+    if hasattr(model, 'wait_for_save'):  # HATModel writes checkpoints in a background thread
+        model.wait_for_save()
     if opt.get('val') is not None:
         for val_loader in val_loaders:
             model.validation(val_loader, current_iter, tb_logger, opt['val']['save_img'])
@@ -3,9 +3,11 @@ import data
 import models
 
 import datetime
+import inspect
 import logging
 import math
 import time
+import os
 import torch
 from os import path as osp
 
@@ -38,6 +40,10 @@ def create_train_val_dataloader(opt, logger):
             dataset_enlarge_ratio = dataset_opt.get('dataset_enlarge_ratio', 1)
             train_set = build_dataset(dataset_opt)
             train_sampler = EnlargedSampler(train_set, opt['world_size'], opt['rank'], dataset_enlarge_ratio)
+            # keep workers alive across epochs and pin batches for both cpu and cuda prefetchers
+            if dataset_opt.get('num_worker_per_gpu', 0) > 0:
+                dataset_opt.setdefault('persistent_workers', True)
+            dataset_opt.setdefault('pin_memory', True)
             train_loader = build_dataloader(
                 train_set,
                 dataset_opt,
@@ -73,8 +79,14 @@ def load_resume_state(opt):
     resume_state_path = None
     if opt['auto_resume']:
         state_path = osp.join('experiments', opt['name'], 'training_states')
-        if osp.isdir(state_path):
+        latest_path = osp.join(state_path, 'latest.state')
+        if osp.islink(latest_path) and osp.isfile(latest_path):
+            resume_state_path = osp.join(state_path, os.readlink(latest_path))
+            opt['path']['resume_state'] = resume_state_path
+        elif osp.isdir(state_path):
+            # fall back to scanning for experiments saved without the latest.state link
             states = list(scandir(state_path, suffix='state', recursive=False, full_path=False))
+            states = [v for v in states if v != 'latest.state']
             if len(states) != 0:
                 states = [float(v.split('.state')[0]) for v in states]
                 resume_state_path = osp.join(state_path, f'{max(states):.0f}.state')
@@ -86,8 +98,11 @@ def load_resume_state(opt):
     if resume_state_path is None:
         resume_state = None
     else:
-        device_id = torch.cuda.current_device()
-        resume_state = torch.load(resume_state_path, map_location=lambda storage, loc: storage.cuda(device_id))
+        # load to (memory-mapped) cpu storage, optimizer.load_state_dict moves the states to the param devices
+        if 'mmap' in inspect.signature(torch.load).parameters:  # torch>=2.1
+            resume_state = torch.load(resume_state_path, map_location='cpu', mmap=True, weights_only=False)
+        else:
+            resume_state = torch.load(resume_state_path, map_location='cpu')
         check_resume(opt, resume_state['iter'])
     return resume_state
 
@@ -98,6 +113,8 @@ def train_pipeline(root_path):
     opt['root_path'] = root_path
 
     torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     # torch.backends.cudnn.deterministic = True
 
     # load resume states if necessary
@@ -209,6 +226,8 @@ def train_pipeline(root_path):
     logger.info(f'End of training. Time consumed: {consumed_time}')
     logger.info('Save the latest model.')
     model.save(epoch=-1, current_iter=-1)  # -1 stands for the latest
+    if hasattr(model, 'wait_for_save'):  # HATModel writes checkpoints in a background thread
+        model.wait_for_save()
     if opt.get('val') is not None:
         for val_loader in val_loaders:
             model.validation(val_loader, current_iter, tb_logger, opt['val']['save_img'])